@@ -12,44 +12,69 @@ develop a new k8s charm using the Operator Framework:
     https://discourse.charmhub.io/t/4208
 """
 
+import base64
+import functools
+import grp
+import hashlib
+import json
 import logging
-from subprocess import check_call, CalledProcessError
+from subprocess import check_call, run
 import os
-import secrets
-import urllib.request
-import shutil
-import imghdr
+from pathlib import Path
+import pwd
+import re
 import tempfile
 
-from jinja2 import Environment, FileSystemLoader
-
 from ops.charm import (
     CharmBase, ConfigChangedEvent, InstallEvent, RelationChangedEvent, RelationCreatedEvent,
     RelationDepartedEvent, RelationJoinedEvent, StartEvent,
 )
-from ops.framework import StoredState
+from ops.framework import PreCommitEvent, StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 
 logger = logging.getLogger(__name__)
 
-# Templates go in the "src/templates".  Get them with
-# `templates.get_template(filename)`.
-templates = Environment(loader=FileSystemLoader("src/templates"))
+# Where to keep data cached by the charm between hook invocations
+CHARM_CACHE_DIR = "/var/cache/mediawiki-charm"
+
+# Renderings of config.php are cached there, keyed by config_php_key()
+CONFIG_PHP_CACHE_DIR = f"{CHARM_CACHE_DIR}/config-php"
+
+# How many config.php renderings to keep in CONFIG_PHP_CACHE_DIR
+CONFIG_PHP_CACHE_SIZE = 8
+
+# Compiled templates are cached there, so that a new hook invocation doesn't
+# need to parse them again.
+JINJA_CACHE_DIR = f"{CHARM_CACHE_DIR}/jinja"
 
 # Where to find the mediawiki maintenance php scripts
 MEDIAWIKI_MAINTENANCE_ROOT = "/usr/share/mediawiki/maintenance"
 
+# Maintenance script shipped with the charm, which creates several admin users
+# in one go
+CREATE_ADMINS_PHP_PATH = "src/php/createAdmins.php"
+
 # Where to put the mediawiki config files
 MEDIAWIKI_CONFIG_DIR = "/etc/mediawiki"
 
 # Root of the mediawiki installation
 MEDIAWIKI_ROOT_DIR = "/var/lib/mediawiki"
 
+# Apache2 site configuration, which is made to serve the mediawiki root
+APACHE_SITE_CONF_PATH = "/etc/apache2/sites-available/000-default.conf"
+
 # Path of the config.php file containing the configuration generated from the
 # charm config.
 CONFIG_PHP_PATH = f"{MEDIAWIKI_CONFIG_DIR}/config.php"
 
+# Keys of the charm config that config.php is rendered from
+CONFIG_PHP_KEYS = ("name", "language", "skin", "server_address", "logo", "debug")
+
+# Path of the file holding the config_php_key() of the values config.php was
+# last generated from
+CONFIG_PHP_KEY_PATH = f"{MEDIAWIKI_CONFIG_DIR}/config.sha256"
+
 # Path of the memcached.php file containing the configuration generated from a
 # memcached relation.
 MEMCACHED_PHP_PATH = f"{MEDIAWIKI_CONFIG_DIR}/memcached.php"
@@ -57,37 +82,115 @@ MEMCACHED_PHP_PATH = f"{MEDIAWIKI_CONFIG_DIR}/memcached.php"
 # Path of the db.php file containing configuration generated from a db relation
 DB_PHP_PATH = f"{MEDIAWIKI_CONFIG_DIR}/db.php"
 
+# The generated config files above, which LocalSettings.php includes
+INCLUDED_CONFIG_PATHS = (CONFIG_PHP_PATH, MEMCACHED_PHP_PATH, DB_PHP_PATH)
+
+# Keys the db relation must provide before the database can be used
+DB_RELATION_KEYS = ("private-address", "database", "user", "password")
+
 # Path of the main mediawiki configuration, which is generated by the
 # install.php maintenance script once the database connection details are known.
 # Include directives are added to also load the scripts above.
 LOCALSETTINGS_PHP_PATH = f"{MEDIAWIKI_CONFIG_DIR}/LocalSettings.php"
 
+# Where the jinja template sources are shipped in the charm
+TEMPLATES_DIR = "src/templates"
+
+# Where the ./compile_templates script puts the precompiled templates, along
+# with the templates_checksum() of the sources they were compiled from
+COMPILED_TEMPLATES_DIR = "src/compiled_templates"
+COMPILED_TEMPLATES_CHECKSUM_PATH = f"{COMPILED_TEMPLATES_DIR}/templates.sha256"
+
+
+# Templates go in TEMPLATES_DIR.  Get them with
+# `templates().get_template(filename)`.  The environment is only created the
+# first time it is needed, as many hooks don't render any template.
+#
+# The ./compile_templates script precompiles them into python modules in
+# COMPILED_TEMPLATES_DIR, which are used instead of the sources when they were
+# compiled from the current sources.
+@functools.lru_cache(maxsize=1)
+def templates():
+    from jinja2 import (
+        ChoiceLoader, Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader,
+    )
+
+    # The cache directory is created by the install hook
+    if os.path.isdir(JINJA_CACHE_DIR):
+        bytecode_cache = FileSystemBytecodeCache(directory=JINJA_CACHE_DIR, pattern="%s.cache")
+    else:
+        bytecode_cache = None
+    loaders = [FileSystemLoader(TEMPLATES_DIR)]
+    compiled_checksum = read_text(COMPILED_TEMPLATES_CHECKSUM_PATH)
+    if compiled_checksum:
+        if compiled_checksum == templates_checksum():
+            loaders.insert(0, ModuleLoader(COMPILED_TEMPLATES_DIR))
+        else:
+            logger.warning("Ignoring compiled templates, which don't match the template sources")
+    # Templates don't change during a hook, so there is no point in checking
+    # whether they are up to date each time they are used.
+    return Environment(
+        loader=ChoiceLoader(loaders), bytecode_cache=bytecode_cache, auto_reload=False)
+
+
+def templates_checksum() -> str:
+    '''
+    Return a hash of the names and contents of the template sources.
+    '''
+    h = hashlib.sha256()
+    for path in sorted(Path(TEMPLATES_DIR).rglob("*")):
+        if path.is_file():
+            h.update(str(path.relative_to(TEMPLATES_DIR)).encode() + b"\0")
+            h.update(hashlib.sha256(path.read_bytes()).digest())
+    return h.hexdigest()
+
+
+def compile_templates():
+    '''
+    Precompile the template sources into COMPILED_TEMPLATES_DIR, recording
+    which sources they were compiled from.
+    '''
+    from jinja2 import Environment, FileSystemLoader
+
+    env = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+    env.compile_templates(COMPILED_TEMPLATES_DIR, zip=None, ignore_errors=False)
+    write_config(COMPILED_TEMPLATES_CHECKSUM_PATH, templates_checksum())
+
 
 class MediawikiCharm(CharmBase):
     """Charm the service."""
 
     _stored = StoredState()
 
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.framework.observe(self.on.install, self._on_install)
-        self.framework.observe(self.on.start, self._on_start)
-        self.framework.observe(self.on.config_changed, self._on_config_changed)
+    # Pairs of (event name, handler name) observed by the charm
+    _HOOKS = (
+        ("install", "_on_install"),
+        ("start", "_on_start"),
+        ("config_changed", "_on_config_changed"),
 
-        self.framework.observe(self.on.db_relation_created, self._on_db_relation_created)
-        self.framework.observe(self.on.db_relation_joined, self._on_db_relation_joined)
-        self.framework.observe(self.on.db_relation_changed, self._on_db_relation_changed)
-        self.framework.observe(self.on.db_relation_departed, self._on_db_relation_departed)
+        ("db_relation_created", "_on_db_relation_created"),
+        ("db_relation_joined", "_on_db_relation_joined"),
+        ("db_relation_changed", "_on_db_relation_changed"),
+        ("db_relation_departed", "_on_db_relation_departed"),
 
-        # self.framework.observe(self.on.replicas_relation_joined,
-        #                        self._on_replicas_relation_changed)
-        self.framework.observe(self.on.replicas_relation_changed,
-                               self._on_replicas_relation_changed)
+        # ("replicas_relation_joined", "_on_replicas_relation_changed"),
+        ("replicas_relation_changed", "_on_replicas_relation_changed"),
 
-        self.framework.observe(self.on.cache_relation_changed, self._on_cache_relation_changed)
-        self.framework.observe(self.on.cache_relation_departed, self._on_cache_relation_departed)
+        ("cache_relation_changed", "_on_cache_relation_changed"),
+        ("cache_relation_departed", "_on_cache_relation_departed"),
 
-        self.framework.observe(self.on.website_relation_joined, self._on_website_relation_joined)
+        ("website_relation_joined", "_on_website_relation_joined"),
+    )
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._stored.set_default(
+            admin_password="", admins_key="", admins_digest="", ingress_addresses={})
+        on, observe = self.on, self.framework.observe
+        for event, handler in self._HOOKS:
+            observe(getattr(on, event), getattr(self, handler))
+        observe(self.framework.on.pre_commit, self._on_pre_commit)
+        self._apache_reload_pending = False
 
     # Lifecycle hooks
 
@@ -96,21 +199,24 @@ class MediawikiCharm(CharmBase):
         try:
             install_mediawiki_packages()
             self.unit.status = WaitingStatus("Mediawiki packages installed")
-        except CalledProcessError as e:
+        except Exception as e:
             logger.error("Package install failed with error: %s", e)
             self.unit.status = BlockedStatus("Failed to install packages")
 
     def _on_start(self, event: StartEvent) -> None:
-        check_call(["open-port", "80"])
+        self.unit.open_port("tcp", 80)
         self.unit.status = self._get_db_relation_status()
 
     def _on_config_changed(self, event: ConfigChangedEvent):
+        # Juju runs config-changed whenever the unit agent starts (e.g. after a
+        # reboot), which is when addresses may have changed.
+        self._stored.ingress_addresses = {}
         self.unit.status = MaintenanceStatus("Updating Mediawiki configuration")
         try:
-            configure_mediawiki(self.config)
+            if configure_mediawiki(self.config):
+                self._reload_apache()
             if self.unit.is_leader() and self.config["admins"]:
-                setup_admins(self.config["admins"])
-            reload_apache()
+                self._setup_admins(self.config["admins"])
             self.unit.status = self._get_db_relation_status()
         except Exception as e:
             logger.error("Error configuring mediawiki: %s", e)
@@ -130,6 +236,9 @@ class MediawikiCharm(CharmBase):
 
     def _on_db_relation_changed(self, event: RelationChangedEvent) -> None:
         db = event.relation.data[event.unit]
+        if not all(key in db for key in DB_RELATION_KEYS):
+            # The remaining connection data will come in a later event
+            return
         configure_db(db)
         if self.unit.is_leader():
             self._install_mediawiki(db)
@@ -139,7 +248,9 @@ class MediawikiCharm(CharmBase):
         self.unit.status = BlockedStatus("Missing db relation")
         try:
             uninstall_mediawiki()
-            reload_apache()
+            self._forget_mediawiki_installed()
+            self._stored.admins_digest = ""
+            self._reload_apache()
         except Exception as e:
             logger.error("Uninstalling failed with error %s", e)
 
@@ -167,24 +278,24 @@ class MediawikiCharm(CharmBase):
 
     def _on_cache_relation_changed(self, event: RelationChangedEvent) -> None:
         try:
-            servers = []
+            # Units come in no particular order, so sort them to get the same
+            # configuration for the same set of servers.
+            addresses = set()
             for unit in event.relation.units:
                 unit_data = event.relation.data[unit]
                 if "private-address" in unit_data and "port" in unit_data:
-                    servers.append({
-                        "address": unit_data["private-address"],
-                        "port": unit_data["port"],
-                    })
-            configure_memcached(servers)
-            reload_apache()
+                    addresses.add((unit_data["private-address"], unit_data["port"]))
+            servers = [{"address": address, "port": port} for address, port in sorted(addresses)]
+            if configure_memcached(servers):
+                self._reload_apache()
         except Exception as e:
             logger.error("Failed to configure memcached: %s", e)
             self.unit.status = BlockedStatus("Memcached configuration failed")
 
     def _on_cache_relation_departed(self, event: RelationDepartedEvent) -> None:
         try:
-            configure_memcached(None)
-            reload_apache()
+            if configure_memcached(None):
+                self._reload_apache()
         except Exception as e:
             logger.error("Unable to remove memcached configuration: %s", e)
             self.unit.status = BlockedStatus("Memcached removal failed")
@@ -194,12 +305,27 @@ class MediawikiCharm(CharmBase):
 
     def _on_website_relation_joined(self, event: RelationJoinedEvent) -> None:
         unit_data = event.relation.data[self.unit]
-        ingress_address = self.model.get_binding('website').network.ingress_address
         unit_data.update({
             "port": "80",
-            "hostname": str(ingress_address),
+            "hostname": self._get_ingress_address("website"),
         })
 
+    # Handlers don't reload apache themselves, they ask for it to be reloaded
+    # once all the events of the hook have been handled.
+
+    def _reload_apache(self) -> None:
+        self._apache_reload_pending = True
+
+    def _on_pre_commit(self, event: PreCommitEvent) -> None:
+        if not self._apache_reload_pending:
+            return
+        self._apache_reload_pending = False
+        try:
+            reload_apache()
+        except Exception as e:
+            logger.error("Failed to reload apache: %s", e)
+            self.unit.status = BlockedStatus("Failed to reload apache")
+
     # Methods that help event hooks
 
     def _get_db(self):
@@ -216,6 +342,17 @@ class MediawikiCharm(CharmBase):
                 if db["slave"] == "False" and "database" in db:
                     return db
 
+    def _get_ingress_address(self, binding: str) -> str:
+        '''
+        Get the ingress address of a binding.  It is remembered across hooks, as
+        looking it up runs network-get.
+        '''
+        address = self._stored.ingress_addresses.get(binding)
+        if address is None:
+            address = str(self.model.get_binding(binding).network.ingress_address)
+            self._stored.ingress_addresses[binding] = address
+        return address
+
     def _get_db_relation_status(self):
         db_rel = self.model.get_relation("db")
         if db_rel is None:
@@ -223,26 +360,70 @@ class MediawikiCharm(CharmBase):
         db = self._get_db()
         if db is None:
             return WaitingStatus("Waiting for connection data from db relation")
-        if is_mediawiki_installed():
+        if self._mediawiki_installed:
             return ActiveStatus()
         return WaitingStatus("Waiting to install Mediawiki")
 
+    # Whether mediawiki is installed is only checked once per hook.  Methods
+    # that install or uninstall it must call _forget_mediawiki_installed().
+
+    @functools.cached_property
+    def _mediawiki_installed(self) -> bool:
+        return is_mediawiki_installed()
+
+    def _forget_mediawiki_installed(self) -> None:
+        self.__dict__.pop("_mediawiki_installed", None)
+
     def _install_mediawiki(self, db):
         try:
             self.unit.status = MaintenanceStatus("Updating mediawiki db configuration")
-            install_mediawiki(db)
-            reload_apache()
+            install_mediawiki(db, self._get_admin_password())
+            # The password is only kept for retrying a failed install
+            self._stored.admin_password = ""
+            self._forget_mediawiki_installed()
+            self._reload_apache()
             self._set_db_connection_status(True)
             self.unit.status = ActiveStatus()
         except Exception as e:
             logger.error("Mediawiki install failed with error: %s", e)
             self.unit.status = BlockedStatus("Failed to install mediawiki")
 
+    def _get_admin_password(self) -> str:
+        '''
+        Return the password of the generic admin user created at install time,
+        generating it the first time.  The same password is used until the
+        install succeeds.
+        '''
+        if not self._stored.admin_password:
+            token = base64.urlsafe_b64encode(os.urandom(32)).rstrip(b"=")
+            self._stored.admin_password = token.decode()
+        return self._stored.admin_password
+
+    def _setup_admins(self, admins: str):
+        '''
+        Set up the admin users from the given "admins" config value, unless
+        they have already been set up from the same value.
+        '''
+        import hmac
+
+        # The value contains passwords, so only a digest keyed with a secret of
+        # the unit is kept.
+        if not self._stored.admins_key:
+            self._stored.admins_key = base64.b64encode(os.urandom(32)).decode()
+        digest = hmac.new(
+            self._stored.admins_key.encode(), admins.encode(), hashlib.sha256).hexdigest()
+        if hmac.compare_digest(digest, self._stored.admins_digest):
+            return
+        setup_admins(admins)
+        self._stored.admins_digest = digest
+
     def _uninstall_mediawiki(self):
         self._set_db_connection_status(False)
         self.unit.status = BlockedStatus("Missing db relation")
         try:
             uninstall_mediawiki()
+            self._forget_mediawiki_installed()
+            self._stored.admins_digest = ""
         except Exception as e:
             logger.error("Uninstalling failed with error %s", e)
 
@@ -271,31 +452,45 @@ def install_mediawiki_packages():
     '''
     # Install mediawiki (which pulls php as a dependency) and imagemagick which
     # allows mediawiki to perform image manipulation.
-    check_call(["apt-get", "install", "-y", "mediawiki", "imagemagick"])
+    install_packages("mediawiki", "imagemagick")
+
+    # Make room for the compiled templates cache
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
 
     # Apache2 is configured by default to serve from /var/www/html.  We replace
     # the DocumentRoot directive in the apache default configuration to point at
     # the mediawiki root.
-    check_call([
-        "sed", "-i",
-        f"s|DocumentRoot .*|DocumentRoot {MEDIAWIKI_ROOT_DIR}|",
-        "/etc/apache2/sites-available/000-default.conf",
-    ])
+    with open(APACHE_SITE_CONF_PATH) as f:
+        site_conf = f.read()
+    site_conf = re.sub(r"DocumentRoot .*", f"DocumentRoot {MEDIAWIKI_ROOT_DIR}", site_conf)
+    write_config(APACHE_SITE_CONF_PATH, site_conf)
+
+
+def install_packages(*packages: str):
+    '''
+    Install the given apt packages, in-process via the python3-apt bindings
+    when they are available.
+    '''
+    try:
+        import apt
+    except ImportError:
+        check_call(["apt-get", "install", "-y", *packages])
+        return
+    cache = apt.Cache()
+    for package in packages:
+        cache[package].mark_install()
+    cache.commit()
 
 
 def are_mediawiki_packages_installed():
     try:
-        check_call([
-            "grep", "-q",
-            f"DocumentRoot {MEDIAWIKI_ROOT_DIR}",
-            "/etc/apache2/sites-available/000-default.conf",
-        ])
-        return True
-    except CalledProcessError:
+        with open(APACHE_SITE_CONF_PATH) as f:
+            return f"DocumentRoot {MEDIAWIKI_ROOT_DIR}" in f.read()
+    except FileNotFoundError:
         return False
 
 
-def install_mediawiki(db):
+def install_mediawiki(db, admin_password: str):
     '''
     Create the wiki database tables and the basic LocalSettings.php file
     '''
@@ -317,7 +512,7 @@ def install_mediawiki(db):
             "--confpath", temp_dir,
             "--installdbuser", db["user"],
             "--installdbpass", db["password"],
-            "--pass", secrets.token_urlsafe(32),
+            "--pass", admin_password,
             "--scriptpath", "",
             "Charmed Wiki",
             "generic_charm_admin"
@@ -325,17 +520,14 @@ def install_mediawiki(db):
 
         # Include the config php files in LocalSettings.  When configuration
         # changes, only that file needs to be regenerated.
+        includes = "".join(f"include('{path}');\n" for path in INCLUDED_CONFIG_PATHS)
         with open(f"{temp_dir}/LocalSettings.php", "a") as f:
-            f.write("\n")
-            f.write(f"include('{CONFIG_PHP_PATH}');\n")
-            f.write(f"include('{MEMCACHED_PHP_PATH}');\n")
-            f.write(f"include('{DB_PHP_PATH}');\n")
+            f.write("\n" + includes)
 
         # Make sure the config php files exists, as LocalSettings
         # will include them.
-        touch_config(CONFIG_PHP_PATH)
-        touch_config(MEMCACHED_PHP_PATH)
-        touch_config(DB_PHP_PATH)
+        for path in INCLUDED_CONFIG_PATHS:
+            touch_config(path)
 
         # Finally swap in the configuration
         os.rename(f"{temp_dir}/LocalSettings.php", LOCALSETTINGS_PHP_PATH)
@@ -345,7 +537,7 @@ def configure_db(db):
     '''
     Regenerate the db.php file with database connection data
     '''
-    template = templates.get_template("db.php")
+    template = templates().get_template("db.php")
     db_php = template.render(db=db)
     write_config(DB_PHP_PATH, db_php)
 
@@ -359,28 +551,71 @@ def uninstall_mediawiki():
     Remove the LocalSettings.php file,  returning mediawiki to its uninstalled
     state.
     '''
-    for f in LOCALSETTINGS_PHP_PATH, CONFIG_PHP_PATH, MEMCACHED_PHP_PATH, DB_PHP_PATH:
-        try:
-            os.remove(f)
-        except FileNotFoundError:
-            pass
+    # The hash of the applied config goes too, so that a new install gets
+    # configured from scratch.
+    for f in (LOCALSETTINGS_PHP_PATH, *INCLUDED_CONFIG_PATHS, CONFIG_PHP_KEY_PATH):
+        Path(f).unlink(missing_ok=True)
 
 
-def configure_mediawiki(conf):
+def configure_mediawiki(conf) -> bool:
     '''
     Overwrite the config.php file containing the mediawiki config that comes
-    from the charm config.
-    '''
-    template = templates.get_template("config.php")
-    config_php = template.render(
-        wiki_name=conf["name"],
-        language_code=conf["language"],
-        skin=conf["skin"],
-        server_address=conf["server_address"],
-        logo_path=fetch_logo(conf["logo"]),
-        debug_file="" if not conf["debug"] else os.getcwd() + "/debug.log",
-    )
-    write_config(CONFIG_PHP_PATH, config_php)
+    from the charm config.  Return True if the file was changed.
+    '''
+    # Nothing to do if config.php was last generated from the same values
+    key = config_php_key(conf)
+    if key == read_text(CONFIG_PHP_KEY_PATH) and os.path.exists(CONFIG_PHP_PATH):
+        return False
+
+    logo_path = fetch_logo(conf["logo"])
+
+    # Renderings are cached by config values, so that re-applying a previous
+    # config doesn't need to go through jinja again.
+    cache_path = f"{CONFIG_PHP_CACHE_DIR}/{key}.php"
+    try:
+        with open(cache_path) as f:
+            config_php = f.read()
+        # Mark the rendering as recently used, so that it is evicted last
+        os.utime(cache_path)
+    except FileNotFoundError:
+        template = templates().get_template("config.php")
+        config_php = template.render(
+            wiki_name=conf["name"],
+            language_code=conf["language"],
+            skin=conf["skin"],
+            server_address=conf["server_address"],
+            logo_path=logo_path,
+            debug_file="" if not conf["debug"] else os.getcwd() + "/debug.log",
+        )
+        os.makedirs(CONFIG_PHP_CACHE_DIR, exist_ok=True)
+        write_config(cache_path, config_php)
+        evict_config_php_cache()
+    changed = update_config(CONFIG_PHP_PATH, config_php)
+    write_config(CONFIG_PHP_KEY_PATH, key)
+    return changed
+
+
+def config_php_key(conf) -> str:
+    '''
+    Return a hash of the charm config values that config.php depends on, and
+    of the config.php template, so that a charm upgrade changing the template
+    causes config.php to be rendered again.
+    '''
+    values = {key: conf[key] for key in CONFIG_PHP_KEYS}
+    h = hashlib.sha256(json.dumps(values, sort_keys=True).encode())
+    with open(f"{TEMPLATES_DIR}/config.php", "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def evict_config_php_cache():
+    '''
+    Remove all but the CONFIG_PHP_CACHE_SIZE most recent renderings of
+    config.php from the cache.
+    '''
+    paths = sorted(Path(CONFIG_PHP_CACHE_DIR).glob("*.php"), key=lambda p: p.stat().st_mtime)
+    for path in paths[:-CONFIG_PHP_CACHE_SIZE]:
+        path.unlink(missing_ok=True)
 
 
 def fetch_logo(logo_url) -> str:
@@ -398,105 +633,210 @@ def fetch_logo(logo_url) -> str:
 
     # Check for an already downloaded this image and return early if that's the
     # case
-    try:
-        with open(logo_src_path) as f:
-            previous_url = f.read()
-    except FileNotFoundError:
-        previous_url = ""
-    if logo_url == previous_url:
+    if logo_url == read_text(logo_src_path):
         return url_logo_path
 
-    # Fetch the image and store it
-    with urllib.request.urlopen(logo_url) as response:
-        content = response.read()
-        ext = imghdr.what(response, content)
-    if ext is None:
-        raise ValueError("logo is not an image")
-    with open(fs_logo_path, "wb") as f:
-        f.write(content)
+    download_logo(logo_url, fs_logo_path)
 
     # Remember we've done that
     with open(logo_src_path, "w") as f:
         f.write(logo_url)
 
-    shutil.chown(fs_logo_path, user="www-data", group="www-data")
     return url_logo_path
 
 
+def download_logo(logo_url, fs_logo_path):
+    '''
+    Download the image at logo_url to fs_logo_path, unless it is the image that
+    is already there.
+    '''
+    import urllib.request
+
+    logo_sha256_path = f"{MEDIAWIKI_CONFIG_DIR}/logo_sha256"
+
+    # The request isn't conditional: the logo is only downloaded when its URL
+    # changed, and validators (ETag, Last-Modified) only apply to the URL that
+    # served them.  A new URL serving the same image is caught by comparing
+    # hashes below instead.
+
+    # Fetch the image and store it.  It is streamed to a temporary file next to
+    # the logo, only its header is kept to check that it is an image.
+    with urllib.request.urlopen(logo_url) as response:
+        head = response.read(32)
+        if image_type(head) is None:
+            raise ValueError("logo is not an image")
+        digest = hashlib.sha256(head)
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(fs_logo_path), delete=False) as f:
+            try:
+                f.write(head)
+                for chunk in iter(lambda: response.read(64 * 1024), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+            except BaseException:
+                os.remove(f.name)
+                raise
+    logo_sha256 = digest.hexdigest()
+
+    # The URL may have changed but not the image, in which case the current
+    # logo can stay in place.
+    if logo_sha256 == read_text(logo_sha256_path) and os.path.exists(fs_logo_path):
+        os.remove(f.name)
+    else:
+        os.chmod(f.name, 0o644)
+        os.chown(f.name, *www_data_ids())
+        os.replace(f.name, fs_logo_path)
+        with open(logo_sha256_path, "w") as sha256_file:
+            sha256_file.write(logo_sha256)
+
+
+# Leading bytes of the image types recognised by image_type()
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+
+@functools.lru_cache(maxsize=1)
+def www_data_ids():
+    '''
+    Return the uid and gid of the www-data user and group that apache runs as.
+    '''
+    return pwd.getpwnam("www-data").pw_uid, grp.getgrnam("www-data").gr_gid
+
+
+def image_type(head: bytes):
+    '''
+    Return the type of the image whose first bytes are given ("png", "jpeg",
+    "gif" or "webp"), or None if they don't look like one of these.
+    '''
+    for signature, kind in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    # WebP files start with "RIFF", then the file size, then "WEBP"
+    if head.startswith(b"RIFF") and head.startswith(b"WEBP", 8):
+        return "webp"
+    return None
+
+
 def setup_admins(admins: str):
     '''
     Make sure the given admin users are setup.
 
     TODO: remove other admins?
     '''
-    for username, pwd in parse_admins(admins):
-        create_or_update_admin(username, pwd)
+    create_or_update_admins(list(parse_admins(admins)))
 
 
 def parse_admins(admins: str):
     '''
     Parse a string of the form "<name1>:<pwd1> <name2>:<pwd2> ..." into
-    a list of pairs [["<name1>", "<pwd1>"], ["<name2>", "<pwd2>"], ...]
+    pairs ("<name1>", "<pwd1>"), ("<name2>", "<pwd2>"), ... which are yielded
+    in turn.
 
     Raise a ValueError if the string is not of the correct format.
     '''
-    name_pwd_pairs = []
     for item in admins.split():
-        if ":" not in item:
+        name, sep, pwd = item.partition(":")
+        if not sep:
             raise ValueError("admin should be in format user:pass")
-        name_pwd_pairs.append(item.split(":", 1))
-    return name_pwd_pairs
+        yield name, pwd
 
 
-def create_or_update_admin(username: str, pwd: str):
+def create_or_update_admins(name_pwd_pairs):
     '''
-    Make sure the specified user exists, has the given password and is an
-    "admin", i.e. belongs to the sysop and bureaucrat groups.
+    Make sure the specified users exist, have the given passwords and are
+    "admins", i.e. belong to the sysop and bureaucrat groups.
+
+    All users are handled by a single php process, which reads them as JSON on
+    its stdin, so that mediawiki is only bootstrapped once.
     '''
-    check_call([
-        "php", f"{MEDIAWIKI_MAINTENANCE_ROOT}/createAndPromote.php",
+    run([
+        "php", CREATE_ADMINS_PHP_PATH,
         "--conf", LOCALSETTINGS_PHP_PATH,
-        "--force",
-        "--sysop", "--bureaucrat",
-        username, pwd,
-    ])
+    ], input=json.dumps(name_pwd_pairs), text=True, check=True)
 
 
-def configure_memcached(servers):
+def configure_memcached(servers) -> bool:
     '''
     Update the memcached configuration with the given servers.  If servers is
-    falsy, instead remove memcached configuration.
+    falsy, instead remove memcached configuration.  Return True if the
+    configuration was changed.
     '''
     if not servers:
         memcached_php = ""
     else:
-        template = templates.get_template("memcached.php")
+        template = templates().get_template("memcached.php")
         memcached_php = template.render(servers=servers)
-    write_config(MEMCACHED_PHP_PATH, memcached_php)
+    return update_config(MEMCACHED_PHP_PATH, memcached_php)
 
 
 def reload_apache():
-    check_call(["service", "apache2", "reload"])
+    '''
+    Ask systemd to reload apache.  systemctl is called directly rather than
+    through the service script, which only runs it.  It waits for the reload
+    job to finish and fails if the reload does.
+    '''
+    check_call(["systemctl", "reload", "apache2.service"])
 
 
 def touch_config(path):
     '''
     Ensure a file exists (potentially creating an empty file) with suitable
-    permissions for being read as config for mediawiki.
+    permissions for being read as config for mediawiki.  An existing file is
+    left alone.
     '''
-    with open(path, "a"):
-        pass
-    os.chmod(path, 0o644)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return
+    # The mode given to os.open is subject to the umask
+    os.fchmod(fd, 0o644)
+    os.close(fd)
 
 
 def write_config(path: str, content: str):
     '''
     Write a file to disk with suitable permissions for being read as config for
-    mediawiki.
+    mediawiki.  The file is replaced atomically so it is never seen partially
+    written.
     '''
-    with open(path, "w") as f:
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+    # The mode given to os.open is subject to the umask, and doesn't apply to
+    # a temporary file left over from an earlier run.
+    os.fchmod(fd, 0o644)
+    with os.fdopen(fd, "w") as f:
         f.write(content)
-    os.chmod(path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def read_text(path: str) -> str:
+    '''
+    Return the contents of a file, or an empty string if it doesn't exist.
+    '''
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+
+def update_config(path: str, content: str) -> bool:
+    '''
+    Like write_config, but leave the file alone if it already has the given
+    content.  Return True if the file was written.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    write_config(path, content)
+    return True
 
 
 if __name__ == "__main__":
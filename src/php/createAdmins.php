@@ -0,0 +1,38 @@
+<?php
+/**
+ * Create or update several admin users with a single MediaWiki bootstrap.
+ *
+ * The users are read from stdin as a JSON list of [username, password] pairs.
+ * Each of them is handled like createAndPromote.php --force --sysop
+ * --bureaucrat would.
+ */
+
+require_once '/usr/share/mediawiki/maintenance/Maintenance.php';
+
+class CreateAdmins extends Maintenance {
+	public function __construct() {
+		parent::__construct();
+		$this->addDescription( 'Create or update the admin users given as JSON on stdin' );
+	}
+
+	public function execute() {
+		global $IP;
+
+		$admins = json_decode( file_get_contents( 'php://stdin' ), true );
+		if ( !is_array( $admins ) ) {
+			$this->fatalError( 'Expected a JSON list of [username, password] pairs' );
+		}
+		foreach ( $admins as list( $username, $password ) ) {
+			$child = $this->runChild( CreateAndPromote::class, "$IP/maintenance/createAndPromote.php" );
+			$child->loadParamsAndArgs(
+				null,
+				[ 'force' => true, 'sysop' => true, 'bureaucrat' => true ],
+				[ $username, $password ]
+			);
+			$child->execute();
+		}
+	}
+}
+
+$maintClass = CreateAdmins::class;
+require_once RUN_MAINTENANCE_IF_MAIN;
@@ -3,15 +3,37 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import io
+import json
+import os
 from subprocess import CalledProcessError
+import sys
+import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, Mock, patch
 
 import charm
 from charm import MediawikiCharm
-from ops.model import BlockedStatus, WaitingStatus
+from ops.model import BlockedStatus, OpenedPort, WaitingStatus
 from ops.testing import Harness
 
+DB_DATA = {
+    "private-address": "10.0.0.1",
+    "database": "mediawiki",
+    "user": "mediawiki",
+    "password": "secret",
+}
+
+PNG_DATA = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+
+
+class FakeResponse(io.BytesIO):
+    """What urllib.request.urlopen() returns, enough for download_logo()."""
+
+    def __init__(self, content, headers=None):
+        super().__init__(content)
+        self.headers = headers or {}
+
 
 class TestCharm(unittest.TestCase):
     def setUp(self):
@@ -19,6 +41,25 @@ class TestCharm(unittest.TestCase):
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
 
+    def end_hook(self):
+        # ops commits the framework once all the events of a hook are handled
+        self.harness.framework.commit()
+
+    def patch_logo_dirs(self):
+        # Point the mediawiki root and config dirs to a temporary directory,
+        # returning its path
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        os.mkdir(f"{temp_dir.name}/images")
+        for patcher in [
+                patch.multiple(
+                    charm, MEDIAWIKI_ROOT_DIR=temp_dir.name, MEDIAWIKI_CONFIG_DIR=temp_dir.name),
+                patch('charm.www_data_ids', return_value=(os.getuid(), os.getgid())),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return temp_dir.name
+
     def check_status(self, expected_status):
         self.assertEqual(
             self.harness.charm.unit.status,
@@ -38,6 +79,31 @@ class TestCharm(unittest.TestCase):
         charm.install_mediawiki_packages.assert_called_once()
         self.check_status(BlockedStatus('Failed to install packages'))
 
+    @patch('charm.check_call')
+    def test_install_packages_apt(self, *unused):
+        apt = MagicMock()
+        with patch.dict(sys.modules, {"apt": apt}):
+            charm.install_packages("mediawiki", "imagemagick")
+        cache = apt.Cache.return_value
+        self.assertEqual(
+            [c.args for c in cache.__getitem__.call_args_list], [("mediawiki",), ("imagemagick",)])
+        self.assertEqual(cache.__getitem__.return_value.mark_install.call_count, 2)
+        cache.commit.assert_called_once()
+        charm.check_call.assert_not_called()
+
+    @patch('charm.check_call')
+    def test_install_packages_apt_get(self, *unused):
+        # A None entry makes importing apt fail
+        with patch.dict(sys.modules, {"apt": None}):
+            charm.install_packages("mediawiki", "imagemagick")
+        charm.check_call.assert_called_once_with(
+            ["apt-get", "install", "-y", "mediawiki", "imagemagick"])
+
+    def test_start(self):
+        self.harness.charm.on.start.emit()
+        self.assertEqual(self.harness.charm.unit.opened_ports(), {OpenedPort("tcp", 80)})
+        self.check_status(BlockedStatus("Missing db relation"))
+
     @patch('charm.configure_mediawiki')
     @patch('charm.reload_apache')
     def test_config_changed_succeeds(self, *unused):
@@ -45,25 +111,193 @@ class TestCharm(unittest.TestCase):
             mock_get_status.return_value = WaitingStatus('foo')  # needs to be a valid status
             self.harness.update_config({"name": "My Wiki"})
             charm.configure_mediawiki.assert_called_once()
+            charm.reload_apache.assert_not_called()
+            self.end_hook()
             charm.reload_apache.assert_called_once()
             mock_get_status.assert_called_once()
             self.assertEqual(self.harness.charm.unit.status, mock_get_status.return_value)
 
+    @patch('charm.configure_mediawiki')
+    @patch('charm.setup_admins')
+    @patch('charm.reload_apache')
+    def test_config_changed_admins(self, *unused):
+        self.harness.set_leader()
+        self.harness.update_config({"admins": "admin:pass"})
+        self.end_hook()
+        charm.setup_admins.assert_called_once_with("admin:pass")
+        charm.reload_apache.assert_called_once()
+
+    @patch('charm.configure_mediawiki')
+    @patch('charm.reload_apache')
+    def test_config_changed_unchanged(self, *unused):
+        charm.configure_mediawiki.return_value = False
+        with patch.object(self.harness.charm, '_get_db_relation_status') as mock_get_status:
+            mock_get_status.return_value = WaitingStatus('foo')
+            self.harness.update_config({"name": "My Wiki"})
+            self.end_hook()
+            charm.configure_mediawiki.assert_called_once()
+            charm.reload_apache.assert_not_called()
+            self.assertEqual(self.harness.charm.unit.status, mock_get_status.return_value)
+
     @patch('charm.configure_mediawiki')
     @patch('charm.reload_apache')
     def test_config_changed_fails(self, *unused):
         charm.configure_mediawiki.side_effect = Exception("foo")
         self.harness.update_config({"name": "My Wiki"})
+        self.end_hook()
         charm.configure_mediawiki.assert_called_once()
         charm.reload_apache.assert_not_called()
         self.check_status(BlockedStatus("Failed to configure mediawiki"))
 
+    def test_config_php_key(self):
+        conf = dict(self.harness.charm.config)
+        key = charm.config_php_key(conf)
+        self.assertEqual(charm.config_php_key({**conf, "admins": "admin:pass"}), key)
+        self.assertNotEqual(charm.config_php_key({**conf, "name": "Other Wiki"}), key)
+
+    def test_configure_mediawiki_template_changed(self):
+        conf = dict(self.harness.charm.config)
+        self.addCleanup(charm.templates.cache_clear)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.mkdir(f"{temp_dir}/templates")
+            template_path = f"{temp_dir}/templates/config.php"
+            with patch.multiple(
+                    charm,
+                    TEMPLATES_DIR=f"{temp_dir}/templates",
+                    CONFIG_PHP_CACHE_DIR=f"{temp_dir}/cache",
+                    CONFIG_PHP_PATH=f"{temp_dir}/config.php",
+                    CONFIG_PHP_KEY_PATH=f"{temp_dir}/config.sha256"):
+                charm.write_config(template_path, "v1 {{ wiki_name }}")
+                charm.templates.cache_clear()
+                self.assertTrue(charm.configure_mediawiki(conf))
+                self.assertFalse(charm.configure_mediawiki(conf))
+                # As after upgrade-charm
+                charm.write_config(template_path, "v2 {{ wiki_name }}")
+                charm.templates.cache_clear()
+                self.assertTrue(charm.configure_mediawiki(conf))
+                self.assertEqual(charm.read_text(f"{temp_dir}/config.php"), f"v2 {conf['name']}")
+
+    @patch('charm.templates_checksum')
+    def test_compiled_templates_absent(self, *unused):
+        self.addCleanup(charm.templates.cache_clear)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch('charm.COMPILED_TEMPLATES_CHECKSUM_PATH', f"{temp_dir}/templates.sha256"):
+                charm.templates.cache_clear()
+                charm.templates()
+        charm.templates_checksum.assert_not_called()
+
+    def test_compiled_templates_stale(self):
+        self.addCleanup(charm.templates.cache_clear)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch.multiple(
+                    charm,
+                    TEMPLATES_DIR=f"{temp_dir}/templates",
+                    COMPILED_TEMPLATES_DIR=f"{temp_dir}/compiled",
+                    COMPILED_TEMPLATES_CHECKSUM_PATH=f"{temp_dir}/compiled/templates.sha256"):
+                os.mkdir(f"{temp_dir}/templates")
+                charm.write_config(f"{temp_dir}/templates/test.txt", "v1")
+                charm.compile_templates()
+                charm.templates.cache_clear()
+                template = charm.templates().get_template("test.txt")
+                self.assertTrue(template.filename.startswith(f"{temp_dir}/compiled/"))
+                charm.write_config(f"{temp_dir}/templates/test.txt", "v2")
+                charm.templates.cache_clear()
+                self.assertEqual(charm.templates().get_template("test.txt").render(), "v2")
+
+    def test_write_config(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = f"{temp_dir}/config.php"
+            # Left over by an interrupted write, with the wrong mode
+            fd = os.open(f"{path}.tmp", os.O_CREAT | os.O_WRONLY, 0o600)
+            os.close(fd)
+            old_umask = os.umask(0o077)
+            try:
+                charm.write_config(path, "<?php")
+            finally:
+                os.umask(old_umask)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+            self.assertEqual(charm.read_text(path), "<?php")
+            self.assertEqual(os.listdir(temp_dir), ["config.php"])
+
+    def test_update_config(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = f"{temp_dir}/config.php"
+            self.assertTrue(charm.update_config(path, "<?php"))
+            os.utime(path, (0, 0))
+            self.assertFalse(charm.update_config(path, "<?php"))
+            self.assertEqual(os.stat(path).st_mtime, 0)
+            self.assertTrue(charm.update_config(path, "<?php // changed"))
+            self.assertEqual(charm.read_text(path), "<?php // changed")
+
+    def test_read_text_missing(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertEqual(charm.read_text(f"{temp_dir}/missing"), "")
+
+    def test_evict_config_php_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i, name in enumerate(["old", "newer", "newest"]):
+                path = f"{temp_dir}/{name}.php"
+                charm.write_config(path, name)
+                os.utime(path, (i, i))
+            with patch.multiple(charm, CONFIG_PHP_CACHE_DIR=temp_dir, CONFIG_PHP_CACHE_SIZE=2):
+                charm.evict_config_php_cache()
+            self.assertEqual(sorted(os.listdir(temp_dir)), ["newer.php", "newest.php"])
+
+    @patch('charm.configure_memcached')
+    @patch('charm.reload_apache')
+    def test_reload_apache_once_per_hook(self, *unused):
+        rel_id = self.harness.add_relation("cache", "memcached")
+        self.harness.add_relation_unit(rel_id, "memcached/0")
+        self.harness.update_relation_data(rel_id, "memcached/0", {"port": "11211"})
+        self.harness.remove_relation_unit(rel_id, "memcached/0")
+        self.assertEqual(charm.configure_memcached.call_count, 2)
+        charm.reload_apache.assert_not_called()
+        self.end_hook()
+        self.end_hook()
+        charm.reload_apache.assert_called_once()
+
+    @patch('charm.check_call')
+    def test_reload_apache(self, *unused):
+        charm.reload_apache()
+        charm.check_call.assert_called_once_with(["systemctl", "reload", "apache2.service"])
+        charm.check_call.side_effect = CalledProcessError(1, "systemctl")
+        with self.assertRaises(CalledProcessError):
+            charm.reload_apache()
+
+    @patch('charm.configure_memcached')
+    @patch('charm.reload_apache')
+    def test_cache_relation_changed_sorted(self, *unused):
+        charm.configure_memcached.return_value = False
+        rel_id = self.harness.add_relation("cache", "memcached")
+        self.harness.add_relation_unit(rel_id, "memcached/0")
+        self.harness.add_relation_unit(rel_id, "memcached/1")
+        self.harness.update_relation_data(
+            rel_id, "memcached/1", {"private-address": "10.0.0.1", "port": "11211"})
+        self.harness.update_relation_data(
+            rel_id, "memcached/0", {"private-address": "10.0.0.2", "port": "11211"})
+        charm.configure_memcached.assert_called_with([
+            {"address": "10.0.0.1", "port": "11211"},
+            {"address": "10.0.0.2", "port": "11211"},
+        ])
+        self.end_hook()
+        charm.reload_apache.assert_not_called()
+
+    def test_website_relation_joined(self):
+        self.harness.add_network("10.0.0.10", endpoint="website")
+        rel_id = self.harness.add_relation("website", "haproxy")
+        self.harness.add_relation_unit(rel_id, "haproxy/0")
+        self.assertEqual(
+            self.harness.get_relation_data(rel_id, self.harness.charm.unit.name),
+            {"port": "80", "hostname": "10.0.0.10"},
+        )
+        self.assertEqual(self.harness.charm._stored.ingress_addresses["website"], "10.0.0.10")
+
     @patch('charm.configure_db')
     def test_db_relation_changed_non_leader(self, *unused):
         with patch.object(self.harness.charm, "_install_mediawiki") as mock_install_mediawiki:
             rel_id = self.harness.add_relation("db", "mysql")
             self.harness.add_relation_unit(rel_id, "mysql/0")
-            db_data = {"key": "val"}
+            db_data = DB_DATA
             self.harness.update_relation_data(rel_id, "mysql/0", db_data)
             charm.configure_db.assert_called_once_with(db_data)
             mock_install_mediawiki.assert_not_called()
@@ -74,9 +308,130 @@ class TestCharm(unittest.TestCase):
         with patch.object(self.harness.charm, "_install_mediawiki") as mock_install_mediawiki:
             rel_id = self.harness.add_relation("db", "mysql")
             self.harness.add_relation_unit(rel_id, "mysql/0")
-            db_data = {"key": "val"}
+            db_data = DB_DATA
             self.harness.update_relation_data(rel_id, "mysql/0", db_data)
             charm.configure_db.assert_called_once_with(db_data)
             mock_install_mediawiki.assert_called_once_with(db_data)
 
+    @patch('charm.configure_db')
+    def test_db_relation_changed_incomplete(self, *unused):
+        self.harness.set_leader()
+        with patch.object(self.harness.charm, "_install_mediawiki") as mock_install_mediawiki:
+            rel_id = self.harness.add_relation("db", "mysql")
+            self.harness.add_relation_unit(rel_id, "mysql/0")
+            self.harness.update_relation_data(rel_id, "mysql/0", {"private-address": "10.0.0.1"})
+            charm.configure_db.assert_not_called()
+            mock_install_mediawiki.assert_not_called()
+
+    def test_get_db(self):
+        with self.harness.hooks_disabled():
+            rel_id = self.harness.add_relation("db", "mysql")
+            self.harness.add_relation_unit(rel_id, "mysql/0")
+            self.harness.add_relation_unit(rel_id, "mysql/1")
+            self.harness.update_relation_data(rel_id, "mysql/0", {"slave": "True"})
+            self.harness.update_relation_data(rel_id, "mysql/1", {**DB_DATA, "slave": "False"})
+        self.assertEqual(self.harness.charm._get_db()["database"], DB_DATA["database"])
+
+    @patch('charm.install_mediawiki')
+    @patch('charm.reload_apache')
+    def test_install_mediawiki_reuses_admin_password(self, *unused):
+        self.harness.add_relation("replicas", "mediawiki")
+        charm.install_mediawiki.side_effect = CalledProcessError(1, "php")
+        self.harness.charm._install_mediawiki({})
+        charm.install_mediawiki.side_effect = None
+        self.harness.charm._install_mediawiki({})
+        (_, pwd1), (_, pwd2) = [c.args for c in charm.install_mediawiki.call_args_list]
+        self.assertTrue(pwd1)
+        self.assertEqual(pwd1, pwd2)
+        # Once the install succeeded, the password isn't kept
+        self.assertEqual(self.harness.charm._stored.admin_password, "")
+
+    def test_image_type(self):
+        self.assertEqual(charm.image_type(b"\x89PNG\r\n\x1a\n\x00\x00"), "png")
+        self.assertEqual(charm.image_type(b"\xff\xd8\xff\xe0"), "jpeg")
+        self.assertEqual(charm.image_type(b"GIF89a\x01\x00"), "gif")
+        self.assertEqual(charm.image_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "webp")
+        self.assertIsNone(charm.image_type(b"RIFF\x00\x00\x00\x00WAVEfmt "))
+        self.assertIsNone(charm.image_type(b"<html>"))
+
+    def test_parse_admins(self):
+        self.assertEqual(list(charm.parse_admins(" a:b  c:d:e ")), [("a", "b"), ("c", "d:e")])
+        with self.assertRaises(ValueError):
+            list(charm.parse_admins("a:b c"))
+
+    @patch('charm.run')
+    def test_setup_admins_single_process(self, *unused):
+        charm.setup_admins("alice:secret bob:pass:word")
+        charm.run.assert_called_once()
+        admins = json.loads(charm.run.call_args.kwargs["input"])
+        self.assertEqual(admins, [["alice", "secret"], ["bob", "pass:word"]])
+
+    @patch('charm.configure_mediawiki')
+    @patch('charm.setup_admins')
+    def test_setup_admins_unchanged(self, *unused):
+        self.harness.set_leader()
+        self.harness.update_config({"admins": "alice:secret"})
+        self.harness.update_config({"name": "My Wiki"})
+        charm.setup_admins.assert_called_once_with("alice:secret")
+        self.assertNotIn("secret", self.harness.charm._stored.admins_digest)
+        self.harness.update_config({"admins": "alice:other"})
+        self.assertEqual(charm.setup_admins.call_count, 2)
+
+    @patch('urllib.request.urlopen')
+    def test_download_logo(self, urlopen):
+        temp_dir = self.patch_logo_dirs()
+        urlopen.return_value = FakeResponse(PNG_DATA)
+        self.assertEqual(charm.fetch_logo("http://example.com/logo.png"), "/images/wiki_logo")
+        with open(f"{temp_dir}/images/wiki_logo", "rb") as f:
+            self.assertEqual(f.read(), PNG_DATA)
+        self.assertEqual(os.stat(f"{temp_dir}/images/wiki_logo").st_mode & 0o777, 0o644)
+        self.assertEqual(os.listdir(f"{temp_dir}/images"), ["wiki_logo"])
+
+    @patch('urllib.request.urlopen')
+    def test_download_logo_not_an_image(self, urlopen):
+        temp_dir = self.patch_logo_dirs()
+        charm.write_config(f"{temp_dir}/images/wiki_logo", "current")
+        urlopen.return_value = FakeResponse(b"<html>" + bytes(1024))
+        with self.assertRaises(ValueError):
+            charm.fetch_logo("http://example.com/logo.png")
+        self.assertEqual(os.listdir(f"{temp_dir}/images"), ["wiki_logo"])
+        self.assertEqual(charm.read_text(f"{temp_dir}/images/wiki_logo"), "current")
+        self.assertEqual(charm.read_text(f"{temp_dir}/logo_url"), "")
+
+    @patch('urllib.request.urlopen')
+    def test_download_logo_interrupted(self, urlopen):
+        temp_dir = self.patch_logo_dirs()
+        response = FakeResponse(PNG_DATA)
+        response.read = Mock(side_effect=[PNG_DATA[:32], OSError("reset")])
+        urlopen.return_value = response
+        with self.assertRaises(OSError):
+            charm.fetch_logo("http://example.com/logo.png")
+        self.assertEqual(os.listdir(f"{temp_dir}/images"), [])
+
+    @patch('urllib.request.urlopen')
+    def test_download_logo_same_image_new_url(self, urlopen):
+        temp_dir = self.patch_logo_dirs()
+        logo_path = f"{temp_dir}/images/wiki_logo"
+        urlopen.return_value = FakeResponse(PNG_DATA)
+        charm.fetch_logo("http://example.com/logo.png?v=1")
+        os.utime(logo_path, (0, 0))
+        urlopen.return_value = FakeResponse(PNG_DATA)
+        charm.fetch_logo("http://example.com/logo.png?v=2")
+        self.assertEqual(urlopen.call_count, 2)
+        # The current logo was kept, and the download was discarded
+        self.assertEqual(os.stat(logo_path).st_mtime, 0)
+        self.assertEqual(os.listdir(f"{temp_dir}/images"), ["wiki_logo"])
+        self.assertEqual(
+            charm.read_text(f"{temp_dir}/logo_url"), "http://example.com/logo.png?v=2")
+
+    @patch('urllib.request.urlopen')
+    def test_download_logo_unconditional(self, urlopen):
+        self.patch_logo_dirs()
+        urlopen.return_value = FakeResponse(PNG_DATA, {"ETag": '"abc"'})
+        charm.fetch_logo("http://example.com/logo.png")
+        urlopen.return_value = FakeResponse(PNG_DATA, {"ETag": '"abc"'})
+        charm.fetch_logo("http://example.org/logo.png")
+        # An ETag from one URL says nothing about another one
+        urlopen.assert_called_with("http://example.org/logo.png")
+
     # TODO: more tests